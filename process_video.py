@@ -2,9 +2,21 @@
 import argparse
 import os
 import subprocess
+import sys
 import shutil
+import queue
+import threading
+import contextlib
+import functools
+import json
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import cv2
+import numpy as np
 import torch
+import torch.nn.functional as F
+import glob
 import logging
 from tqdm import tqdm
 from basicsr.archs.rrdbnet_arch import RRDBNet
@@ -14,123 +26,921 @@ from realesrgan import RealESRGANer
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 1 MiB pipe buffers keep ffmpeg from stalling on small reads/writes
+PIPE_BUFSIZE = 1 << 20
+
+# Rough peak number of live RRDBNet activations per input pixel, used to size
+# batches against free VRAM when --batch_size is left on auto
+ESRGAN_ACTIVATIONS_PER_PIXEL = 2048
+VRAM_BUDGET = 0.5
+MAX_AUTO_BATCH = 16
+# Batch size engines are built for by --trt_engine auto without --batch_size
+TRT_AUTO_BATCH = 4
+
+PRECISIONS = {
+    'fp32': torch.float32,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16,
+}
+
+# Batches in flight between the decode, inference and encode stages; bounded
+# so a slow stage applies back-pressure instead of filling RAM/VRAM
+PIPELINE_DEPTH = 4
+QUEUE_POLL = 0.1
+
+# Fixed keyframe interval (-g) so seeking costs the same everywhere in the
+# file; only libx264 honours -keyint_min/-sc_threshold
+GOP_SIZE = 120
+# Lookahead would otherwise insert extra I-frames at scene cuts
+NVENC_RC = ['-tune', 'hq', '-rc', 'vbr', '-b:v', '0', '-rc-lookahead', '32', '-spatial_aq', '1',
+            '-no-scenecut', '1']
+NVDEC = ['-hwaccel', 'cuda']
+
+# 'global' goes before the encoder's inputs, 'decode' before the decoder's
+# input (a GPU with NVENC also has NVDEC) and 'output' selects the codec.
+# 'preset' and 'quality' are defaults for --preset and --crf.
+VIDEO_ENCODERS = {
+    'x264': {
+        # medium is the x264 sweet spot; slow costs ~2x for a few % bitrate
+        'preset': 'medium',
+        'quality': ('-crf', 19),
+        'output': ['-c:v', 'libx264', '-threads', '0',
+                   '-keyint_min', str(GOP_SIZE), '-sc_threshold', '0',
+                   '-x264-params', 'threads=auto:sliced-threads=0', '-pix_fmt', 'yuv420p'],
+    },
+    'nvenc': {
+        'decode': NVDEC,
+        'preset': 'p5',
+        'quality': ('-cq', 19),
+        'output': ['-c:v', 'h264_nvenc', *NVENC_RC, '-pix_fmt', 'yuv420p'],
+    },
+    'nvenc_hevc': {
+        'decode': NVDEC,
+        'preset': 'p5',
+        'quality': ('-cq', 19),
+        'output': ['-c:v', 'hevc_nvenc', *NVENC_RC, '-pix_fmt', 'yuv420p', '-tag:v', 'hvc1'],
+    },
+    'qsv': {
+        'preset': 'slow',
+        'quality': ('-global_quality', 19),
+        'output': ['-c:v', 'h264_qsv', '-pix_fmt', 'nv12'],
+    },
+    'vaapi': {
+        'global': ['-vaapi_device', '/dev/dri/renderD128'],
+        'quality': ('-qp', 19),
+        'output': ['-vf', 'format=nv12,hwupload', '-c:v', 'h264_vaapi'],
+    },
+}
+
+# Encoder/decoder probe results survive between runs, keyed on the ffmpeg binary and
+# NVIDIA driver so an upgrade of either re-probes
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                         'video-restoration-suite')
+
+# Containers that can carry the moov atom up front for progressive playback
+FASTSTART_EXTENSIONS = ('.mp4', '.m4v', '.mov')
+# Anything smaller is a header with no frames, not a video
+MIN_OUTPUT_BYTES = 1024
+
+def encoder_cache_key():
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        return None
+    driver = ''
+    try:
+        with open('/proc/driver/nvidia/version') as f:
+            driver = f.readline().strip()
+    except OSError:
+        pass
+    return f'{os.path.realpath(ffmpeg)}:{os.stat(ffmpeg).st_mtime_ns}:{driver}'
+
+def cached_probe(name, run_probe):
+    key = encoder_cache_key()
+    if key is None:
+        return False
+    cache_path = os.path.join(CACHE_DIR, 'encoders.json')
+    cached = {}
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if cached.get('key') != key:
+            cached = {}
+        elif name in cached:
+            return cached[name]
+    except (OSError, ValueError):
+        cached = {}
+        
+    available = run_probe()
+    
+    # Write then rename, so a concurrent reader never sees a truncated file
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump({**cached, 'key': key, name: available}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        logger.debug(f"Could not write encoder cache {cache_path}")
+    return available
+
+@functools.lru_cache(maxsize=None)
+def nvenc_available():
+    # h264_nvenc can be compiled in without a usable GPU (or on GPUs with no
+    # NVENC block), so try a tiny encode instead of grepping `ffmpeg -encoders`
+    def run_probe():
+        result = subprocess.run([
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', 'color=size=256x256:duration=0.1',
+            '-c:v', 'h264_nvenc',
+            '-f', 'null', '-'
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return result.returncode == 0
+    return cached_probe('nvenc', run_probe)
+
+@functools.lru_cache(maxsize=None)
+def nvdec_available():
+    # Compute GPUs (A100, H100) have NVDEC but no NVENC, so this can't be
+    # inferred from the encoder probe. Decode a tiny H.264 clip keeping the
+    # frames on the GPU: hwdownload fails if ffmpeg fell back to software
+    def run_probe():
+        clip = subprocess.run([
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', 'testsrc=size=256x256:duration=0.1',
+            '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+            '-f', 'h264', '-'
+        ], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if clip.returncode != 0:
+            return False
+        result = subprocess.run([
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            *NVDEC, '-hwaccel_output_format', 'cuda',
+            '-f', 'h264', '-i', '-',
+            '-vf', 'hwdownload,format=nv12',
+            '-f', 'null', '-'
+        ], input=clip.stdout, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return result.returncode == 0
+    return cached_probe('nvdec', run_probe)
+
+def parse_frame_rate(rate):
+    # ffprobe reports rates as "num/den", e.g. "30000/1001"
+    num, _, den = rate.partition('/')
+    num, den = float(num), float(den or 1)
+    if num <= 0 or den <= 0:
+        raise ValueError(f"Invalid frame rate {rate!r}")
+    return num / den
+
+@functools.lru_cache(maxsize=8)
+def probe(video_path):
+    # One ffprobe per file; every stage reads its metadata from here
+    result = subprocess.run([
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'stream=width,height,r_frame_rate,pix_fmt,nb_frames,duration:format=duration',
+        '-of', 'json',
+        video_path
+    ], stdout=subprocess.PIPE, text=True, check=True)
+    info = json.loads(result.stdout)
+    stream = info['streams'][0]
+    nb_frames = stream.get('nb_frames')
+    # The format duration is the longest stream's, often audio that outlasts
+    # the video, so only use it when the stream has none (MKV, WebM)
+    duration = stream.get('duration') or info.get('format', {}).get('duration')
+    return {
+        'width': int(stream['width']),
+        'height': int(stream['height']),
+        'fps': parse_frame_rate(stream['r_frame_rate']),
+        'frame_rate': stream['r_frame_rate'],  # exact rational for ffmpeg
+        'pix_fmt': stream.get('pix_fmt'),
+        'nb_frames': int(nb_frames) if nb_frames and nb_frames.isdigit() else None,
+        'duration': float(duration) if duration else None,
+    }
+
+def encoder_args(name, preset=None, quality=None):
+    encoder = VIDEO_ENCODERS[name]
+    args = list(encoder['output'])
+    args += ['-g', str(GOP_SIZE)]
+    preset = preset or encoder.get('preset')
+    if preset:
+        args += ['-preset', preset]
+    flag, default_quality = encoder['quality']
+    args += [flag, str(default_quality if quality is None else quality)]
+    return args
+
+def container_args(output):
+    if os.path.splitext(output)[1].lower() in FASTSTART_EXTENSIONS:
+        return ['-movflags', '+faststart']
+    return []
+
+def pick_encoder(choice):
+    if choice == 'auto':
+        choice = 'nvenc' if nvenc_available() else 'x264'
+    return choice
+
+def queue_put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=QUEUE_POLL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def queue_get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=QUEUE_POLL)
+        except queue.Empty:
+            continue
+    return None
+
+def on_stream(stream):
+    return torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext()
+
+class BatchRealESRGANer(RealESRGANer):
+    """RealESRGANer that upscales a stack of frames with a single model call."""
+    
+    def __init__(self, *args, dtype=torch.float32, channels_last=False, **kwargs):
+        super().__init__(*args, half=dtype == torch.float16, **kwargs)
+        self.dtype = dtype
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.model = self.model.to(dtype=dtype, memory_format=self.memory_format)
+        
+    def pad_batch(self):
+        # Same padding as RealESRGANer.pre_process, applied to the whole batch
+        if self.pre_pad != 0:
+            self.img = F.pad(self.img, (0, self.pre_pad, 0, self.pre_pad), 'reflect')
+        if self.scale == 2:
+            self.mod_scale = 2
+        elif self.scale == 1:
+            self.mod_scale = 4
+        if self.mod_scale is not None:
+            _, _, h, w = self.img.size()
+            self.mod_pad_h = (self.mod_scale - h % self.mod_scale) % self.mod_scale
+            self.mod_pad_w = (self.mod_scale - w % self.mod_scale) % self.mod_scale
+            self.img = F.pad(self.img, (0, self.mod_pad_w, 0, self.mod_pad_h), 'reflect')
+    
+    def tile_process(self):
+        # RealESRGANer.tile_process without the per-tile print and without
+        # swallowing RuntimeError, which turns CUDA OOM into a stale tile
+        _, _, height, width = self.img.shape
+        self.output = self.img.new_zeros((*self.img.shape[:2], height * self.scale, width * self.scale))
+        tiles_x = math.ceil(width / self.tile_size)
+        tiles_y = math.ceil(height / self.tile_size)
+        
+        for y in range(tiles_y):
+            for x in range(tiles_x):
+                start_x, start_y = x * self.tile_size, y * self.tile_size
+                end_x = min(start_x + self.tile_size, width)
+                end_y = min(start_y + self.tile_size, height)
+                pad_start_x = max(start_x - self.tile_pad, 0)
+                pad_end_x = min(end_x + self.tile_pad, width)
+                pad_start_y = max(start_y - self.tile_pad, 0)
+                pad_end_y = min(end_y + self.tile_pad, height)
+                
+                output_tile = self.model(self.img[:, :, pad_start_y:pad_end_y, pad_start_x:pad_end_x])
+                
+                tile_x = (start_x - pad_start_x) * self.scale
+                tile_y = (start_y - pad_start_y) * self.scale
+                self.output[:, :, start_y * self.scale:end_y * self.scale,
+                            start_x * self.scale:end_x * self.scale] = output_tile[
+                    :, :, tile_y:tile_y + (end_y - start_y) * self.scale,
+                    tile_x:tile_x + (end_x - start_x) * self.scale]
+    
+    @torch.inference_mode()
+    def enhance_batch(self, batch):
+        # batch: (B, H, W, 3) uint8 RGB tensor already on self.device
+        batch = batch.permute(0, 3, 1, 2)  # NHWC -> NCHW
+        batch = batch.to(dtype=self.dtype, memory_format=self.memory_format)
+        self.img = batch.div_(255)
+        self.pad_batch()
+        
+        if self.tile_size > 0:
+            self.tile_process()
+        else:
+            self.process()
+        output = self.post_process()
+        
+        output = output.clamp_(0, 1).mul_(255).round_().byte()
+        return output.permute(0, 2, 3, 1).contiguous()
+
+class TensorRTModel:
+    """Callable stand-in for RRDBNet backed by a serialized TensorRT engine."""
+    
+    def __init__(self, engine_path):
+        import tensorrt as trt
+        
+        self.engine_path = engine_path
+        with open(engine_path, 'rb') as f:
+            runtime = trt.Runtime(trt.Logger(trt.Logger.WARNING))
+            self.engine = runtime.deserialize_cuda_engine(f.read())
+        if self.engine is None:
+            raise RuntimeError(f"Failed to load TensorRT engine {engine_path}")
+        self.context = self.engine.create_execution_context()
+        
+        names = [self.engine.get_tensor_name(i) for i in range(self.engine.num_io_tensors)]
+        self.input_name = next(n for n in names if self.engine.get_tensor_mode(n) == trt.TensorIOMode.INPUT)
+        self.output_name = next(n for n in names if self.engine.get_tensor_mode(n) == trt.TensorIOMode.OUTPUT)
+        dtypes = {trt.DataType.FLOAT: torch.float32, trt.DataType.HALF: torch.float16}
+        self.input_dtype = dtypes[self.engine.get_tensor_dtype(self.input_name)]
+        self.output_dtype = dtypes[self.engine.get_tensor_dtype(self.output_name)]
+        # Optimisation profile 0 is what build_trt.py creates: [min, opt, max]
+        self.min_shape, _, self.max_shape = self.engine.get_tensor_profile_shape(self.input_name, 0)
+        self.max_batch = self.max_shape[0]
+        
+    def __call__(self, x):
+        x = x.to(self.input_dtype).contiguous()
+        if not self.context.set_input_shape(self.input_name, tuple(x.shape)):
+            raise RuntimeError(f"Input shape {tuple(x.shape)} is outside the range "
+                               f"{tuple(self.min_shape)}-{tuple(self.max_shape)} engine "
+                               f"{self.engine_path} was built for; rebuild it with scripts/build_trt.py")
+        output = torch.empty(tuple(self.context.get_tensor_shape(self.output_name)),
+                             dtype=self.output_dtype, device=x.device)
+        self.context.set_tensor_address(self.input_name, x.data_ptr())
+        self.context.set_tensor_address(self.output_name, output.data_ptr())
+        if not self.context.execute_async_v3(torch.cuda.current_stream().cuda_stream):
+            raise RuntimeError("TensorRT inference failed")
+        return output
+
+def cached_trt_engine(args, width, height):
+    # An engine only covers the shapes it was built for: the padded tile
+    # when tiling, otherwise the whole frame
+    if args.tile_size > 0:
+        shape = f'tile{args.tile_size}'
+    else:
+        shape = f'{width}x{height}'
+    precision = 'fp32' if args.precision == 'fp32' else 'fp16'
+    batch_size = args.batch_size or TRT_AUTO_BATCH
+    model_name = os.path.splitext(os.path.basename(args.model_path))[0]
+    engine_path = os.path.join(CACHE_DIR, f'{model_name}_x{args.scale}_{shape}_b{batch_size}_{precision}.engine')
+    if os.path.exists(engine_path):
+        return engine_path
+    
+    logger.info(f"Building TensorRT engine {engine_path} (one-off, may take minutes)")
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    subprocess.run([
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts', 'build_trt.py'),
+        '--model_path', args.model_path,
+        '--scale', str(args.scale),
+        '--engine', engine_path,
+        '--precision', precision,
+        '--tile_size', str(args.tile_size),
+        # Leave room for the mod_scale padding of odd-sized frames
+        '--max_width', str(-(-width // 4) * 4),
+        '--max_height', str(-(-height // 4) * 4),
+        '--batch_size', str(batch_size),
+    ], check=True)
+    return engine_path
+
 class VideoUpscaler:
-    def __init__(self, args):
+    def __init__(self, args, segment=None, vram_share=1.0):
         self.args = args
+        self.input = args.input
+        self.output = args.output
         self.temp_dir = os.path.abspath(args.temp_dir)
-        self.frame_dir = os.path.join(self.temp_dir, "frames")
-        self.enhanced_dir = os.path.join(self.temp_dir, "enhanced")
-        self.ensure_paths()
+        self.encoder = pick_encoder(args.encoder)
+        # (first_frame, frame_count) when upscaling one shard of the input;
+        # frame_count None means "until the end"
+        self.segment = segment
+        self.vram_share = vram_share
+        # Built on first use and kept resident, along with the batch shapes
+        # it has already been warmed up for
+        self.upscaler = None
+        self.warmed_shapes = set()
         
-    def ensure_paths(self):
-        os.makedirs(self.frame_dir, exist_ok=True)
-        os.makedirs(self.enhanced_dir, exist_ok=True)
+        # Every batch has the same shape, so let cuDNN autotune once per shape
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
         
-    def get_video_fps(self, video_path):
-        result = subprocess.run([
-            'ffprobe', '-v', 'error',
-            '-select_streams', 'v',
-            '-of', 'default=noprint_wrappers=1:nokey=1',
-            '-show_entries', 'stream=r_frame_rate',
-            video_path
-        ], stdout=subprocess.PIPE, text=True)
-        return float(eval(result.stdout.strip()))
-    
-    def extract_frames(self):
-        logger.info(f"Extracting frames to {self.frame_dir}")
-        subprocess.run([
+    def expected_frames(self):
+        nb_frames = probe(self.input)['nb_frames']
+        if self.segment is None:
+            return nb_frames
+        first_frame, frame_count = self.segment
+        if frame_count is None and nb_frames is not None:
+            return max(0, nb_frames - first_frame)
+        return frame_count
+    
+    def open_decoder(self):
+        # Raw RGB frames on stdout (the model's channel order, so nothing has
+        # to swap channels), no intermediate files; hardware decoders
+        # download frames to system memory for us
+        hwaccel = VIDEO_ENCODERS[self.encoder].get('decode', [])
+        # A CPU encoder leaves NVDEC idle, and on HD+ sources software
+        # decoding can be the bottleneck; ffmpeg falls back to software
+        # for codecs NVDEC can't handle
+        if not hwaccel and self.encoder == 'x264' and nvdec_available():
+            hwaccel = NVDEC
+        seek, limit = [], []
+        if self.segment is not None:
+            first_frame, frame_count = self.segment
+            # Seek half a frame early so rounding never skips the first frame
+            start_time = max(0.0, (first_frame - 0.5) / probe(self.input)['fps'])
+            seek = ['-ss', f'{start_time:.6f}']
+            if frame_count is not None:
+                limit = ['-frames:v', str(frame_count)]
+        return subprocess.Popen([
             'ffmpeg', '-hide_banner', '-loglevel', 'error',
-            '-i', self.args.input,
-            '-qscale:v', '1',
+            *hwaccel,
+            *seek,
+            '-i', self.input,
+            '-f', 'rawvideo',
+            '-pix_fmt', 'rgb24',
             '-vsync', '0',
-            f'{self.frame_dir}/%06d.jpg'
-        ], check=True)
+            *limit,
+            '-'
+        ], stdout=subprocess.PIPE, bufsize=PIPE_BUFSIZE)
         
+    def get_upscaler(self):
+        if self.upscaler is None:
+            self.upscaler = self.initialize_upscaler()
+        return self.upscaler
+    
     def initialize_upscaler(self):
+        use_cuda = torch.cuda.is_available()
+        precision = self.args.precision
+        if not use_cuda and precision != 'fp32':
+            logger.warning(f"{precision} inference needs CUDA, falling back to fp32")
+            precision = 'fp32'
+            
         model = RRDBNet(
             num_in_ch=3, num_out_ch=3,
             num_feat=64, num_block=23,
             num_grow_ch=32, scale=self.args.scale
         )
-        return RealESRGANer(
+        upscaler = BatchRealESRGANer(
             scale=self.args.scale,
             model_path=self.args.model_path,
             model=model,
             tile=self.args.tile_size,
             tile_pad=10,
             pre_pad=0,
-            device='cuda' if torch.cuda.is_available() else 'cpu'
+            dtype=PRECISIONS[precision],
+            # NHWC lets cuDNN pick tensor-core convs on Ampere+, but some
+            # model variants run slower with it, so it is opt-in
+            channels_last=use_cuda and self.args.channels_last,
+            # RealESRGANer keeps a string as-is, but .type is used below
+            device=torch.device('cuda' if use_cuda else 'cpu')
         )
+        
+        if self.args.trt_engine:
+            if not use_cuda:
+                raise RuntimeError("--trt_engine requires CUDA")
+            # 'auto' engines depend on the input shape and are loaded per clip
+            if self.args.trt_engine != 'auto':
+                self.load_trt_engine(upscaler, self.args.trt_engine)
+        elif self.args.compile and use_cuda:
+            logger.info("Compiling model with torch.compile (first batches will be slow)")
+            upscaler.model = torch.compile(upscaler.model, mode='reduce-overhead', fullgraph=False)
+        return upscaler
+    
+    def load_trt_engine(self, upscaler, engine_path):
+        if getattr(upscaler.model, 'engine_path', None) == engine_path:
+            return
+        logger.info(f"Running inference through TensorRT engine {engine_path}")
+        upscaler.model = TensorRTModel(engine_path)
+        self.warmed_shapes.clear()
+        
+    def open_encoder(self, width, height, fps):
+        # Shards are video-only; audio and container flags are handled once
+        # when they are joined
+        encoder = VIDEO_ENCODERS[self.encoder]
+        if self.segment is None:
+            audio = [
+                '-i', self.input,
+                '-map', '0:v:0',
+                '-map', '1:a:0?',  # Optional audio
+                '-c:a', 'copy',
+            ]
+            container = container_args(self.output)
+        else:
+            audio = ['-an']
+            container = []
+        return subprocess.Popen([
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            *encoder.get('global', []),
+            '-f', 'rawvideo',
+            '-pix_fmt', 'rgb24',
+            '-s', f'{width}x{height}',
+            '-framerate', str(fps),
+            '-i', '-',
+            *audio,
+            *encoder_args(self.encoder, self.args.preset, self.args.crf),
+            *container,
+            '-y',  # Overwrite without asking
+            self.output
+        ], stdin=subprocess.PIPE, bufsize=PIPE_BUFSIZE)
+    
+    def choose_batch_size(self, upscaler, width, height):
+        batch_size = self.estimate_batch_size(upscaler, width, height)
+        # A TensorRT engine can't run batches beyond its optimisation profile
+        max_batch = getattr(upscaler.model, 'max_batch', None)
+        if max_batch is not None and batch_size > max_batch:
+            logger.warning(f"Clamping batch size {batch_size} to the engine maximum of {max_batch}")
+            batch_size = max_batch
+        return batch_size
     
-    def process_frames(self):
-        upscaler = self.initialize_upscaler()
-        frame_files = sorted([f for f in os.listdir(self.frame_dir) if f.endswith('.jpg')])
+    def estimate_batch_size(self, upscaler, width, height):
+        if self.args.batch_size > 0:
+            return self.args.batch_size
+        if upscaler.device.type != 'cuda':
+            return 1
         
-        logger.info(f"Processing {len(frame_files)} frames")
-        for frame_file in tqdm(frame_files, desc="Upscaling"):
+        # With tiling each forward only sees one (padded) tile per frame
+        if self.args.tile_size > 0:
+            tile = self.args.tile_size + 2 * upscaler.tile_pad
+            pixels = min(tile, width) * min(tile, height)
+        else:
+            pixels = width * height
+        free_bytes, _ = torch.cuda.mem_get_info(upscaler.device)
+        dtype_bytes = torch.finfo(upscaler.dtype).bits // 8
+        out_pixels = width * height * self.args.scale ** 2
+        frame_bytes = (
+            pixels * ESRGAN_ACTIVATIONS_PER_PIXEL * dtype_bytes
+            # The full-frame model output (tile_process stitches into one)
+            + out_pixels * 3 * dtype_bytes
+            # uint8 results waiting in write_q, plus one on each side of it
+            + (self.pipeline_depth() + 2) * out_pixels * 3
+        )
+        batch_size = int(free_bytes * VRAM_BUDGET * self.vram_share) // frame_bytes
+        return max(1, min(batch_size, MAX_AUTO_BATCH))
+    
+    def pipeline_depth(self):
+        return max(1, self.args.prefetch)  # maxsize=0 would mean unbounded
+        
+    def enhance_with_backoff(self, upscaler, batch):
+        # On CUDA OOM, halve the sub-batch fed to the model instead of failing
+        # the run; the smaller size sticks for the rest of the video
+        while True:
             try:
-                frame_path = os.path.join(self.frame_dir, frame_file)
-                frame = cv2.imread(frame_path)
-                if frame is None:
-                    raise ValueError(f"Failed to read {frame_path}")
-                
-                enhanced, _ = upscaler.enhance(frame, outscale=self.args.scale)
-                cv2.imwrite(os.path.join(self.enhanced_dir, frame_file), enhanced)
-                
-                if not self.args.keep_temp:
-                    os.remove(frame_path)
+                outputs = [upscaler.enhance_batch(chunk) for chunk in batch.split(self.chunk_size)]
+                return outputs[0] if len(outputs) == 1 else torch.cat(outputs)
+            except torch.cuda.OutOfMemoryError:
+                if self.chunk_size == 1:
+                    raise
+                self.chunk_size //= 2
+                torch.cuda.empty_cache()
+                logger.warning(f"CUDA out of memory, retrying with batches of {self.chunk_size}")
+    
+    def warm_up(self, upscaler, batch_size, width, height):
+        # cuDNN autotuning, torch.compile and TensorRT all pay a one-off cost
+        # per input shape; pay it here rather than inside the first tqdm tick
+        shape = (batch_size, height, width)
+        if upscaler.device.type != 'cuda' or self.args.warmup_batches <= 0 or shape in self.warmed_shapes:
+            return
+        self.warmed_shapes.add(shape)
+        logger.info(f"Warming up with {self.args.warmup_batches} dummy batches")
+        dummy = torch.zeros((batch_size, height, width, 3), dtype=torch.uint8, device=upscaler.device)
+        for _ in range(self.args.warmup_batches):
+            self.enhance_with_backoff(upscaler, dummy)
+        torch.cuda.synchronize(upscaler.device)
+    
+    def read_batch(self, decoder, frames, frame_bytes):
+        # Read straight into the staging buffer, no per-frame bytes objects
+        count = 0
+        while count < len(frames):
+            read = decoder.stdout.readinto(memoryview(frames[count]).cast('B'))
+            if read < frame_bytes:
+                if read:
+                    logger.warning("Dropping truncated trailing frame")
+                break
+            count += 1
+        return count
+    
+    def read_stage(self, decoder, frame_bytes, free_q, read_q, stop, errors):
+        try:
+            while True:
+                host_batch = queue_get(free_q, stop)
+                if host_batch is None:
+                    return
+                frames = host_batch.numpy()
+                count = self.read_batch(decoder, frames, frame_bytes)
+                if count == 0:
+                    break
+                # Pad a short final batch with its last frame so the model never
+                # sees a new batch shape (and cuDNN never re-benchmarks)
+                frames[count:] = frames[count - 1]
+                if not queue_put(read_q, (host_batch, count), stop):
+                    return
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        queue_put(read_q, None, stop)
+        
+    def write_stage(self, encoder, write_q, host_out, d2h_stream, progress, stop, errors):
+        try:
+            while True:
+                item = queue_get(write_q, stop)
+                if item is None:
+                    return
+                enhanced, count, done = item
+                if isinstance(enhanced, torch.Tensor):
+                    if d2h_stream is not None:
+                        # Download into the reused pinned buffer instead of a
+                        # fresh pageable allocation per batch
+                        with on_stream(d2h_stream):
+                            d2h_stream.wait_event(done)
+                            host_out[:count].copy_(enhanced, non_blocking=True)
+                        d2h_stream.synchronize()
+                        enhanced = host_out[:count]
+                    enhanced = enhanced.numpy()
+                # ndarrays go to the pipe as-is, without a tobytes() copy
+                encoder.stdin.write(np.ascontiguousarray(enhanced))
+                progress.update(count)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+    
+    def process_frames(self, decoder, encoder, width, height):
+        upscaler = self.get_upscaler()
+        if self.args.trt_engine == 'auto':
+            self.load_trt_engine(upscaler, cached_trt_engine(self.args, width, height))
+        scale = self.args.scale
+        frame_bytes = width * height * 3
+        batch_size = self.choose_batch_size(upscaler, width, height)
+        use_cuda = upscaler.device.type == 'cuda'
+        self.chunk_size = batch_size
+        self.warm_up(upscaler, batch_size, width, height)
+        
+        # Pinned staging buffers let host->device copies run asynchronously;
+        # two spares keep the reader busy while batches sit in the queues
+        free_q = queue.Queue()
+        depth = self.pipeline_depth()
+        for _ in range(depth + 2):
+            free_q.put(torch.empty((batch_size, height, width, 3), dtype=torch.uint8,
+                                   pin_memory=use_cuda))
+        host_out = None
+        if use_cuda:
+            host_out = torch.empty((batch_size, height * scale, width * scale, 3),
+                                   dtype=torch.uint8, pin_memory=True)
+        read_q = queue.Queue(maxsize=depth)
+        write_q = queue.Queue(maxsize=depth)
+        copy_stream = torch.cuda.Stream() if use_cuda else None
+        compute_stream = torch.cuda.Stream() if use_cuda else None
+        d2h_stream = torch.cuda.Stream() if use_cuda else None
+        stop = threading.Event()
+        errors = []
+        
+        logger.info(f"Processing {width}x{height} frames in batches of {batch_size}")
+        index = 0
+        with tqdm(total=self.expected_frames(), desc="Upscaling", unit="frame") as progress:
+            reader = threading.Thread(target=self.read_stage, daemon=True,
+                                      args=(decoder, frame_bytes, free_q, read_q, stop, errors))
+            writer = threading.Thread(target=self.write_stage, daemon=True,
+                                      args=(encoder, write_q, host_out, d2h_stream, progress, stop, errors))
+            reader.start()
+            writer.start()
+            try:
+                while True:
+                    item = queue_get(read_q, stop)
+                    if item is None:
+                        break
+                    host_batch, count = item
+                    uploaded = done = None
                     
-            except Exception as e:
-                logger.error(f"Error processing {frame_file}: {str(e)}")
-                if self.args.skip_errors:
-                    continue
-                raise
+                    try:
+                        with on_stream(copy_stream):
+                            batch = host_batch.to(upscaler.device, non_blocking=True)
+                            if use_cuda:
+                                uploaded = copy_stream.record_event()
+                        with on_stream(compute_stream):
+                            if use_cuda:
+                                compute_stream.wait_event(uploaded)
+                                # batch was allocated on the copy stream
+                                batch.record_stream(compute_stream)
+                            enhanced = self.enhance_with_backoff(upscaler, batch)[:count]
+                            if use_cuda:
+                                done = compute_stream.record_event()
+                    except Exception as e:
+                        logger.error(f"Error processing frames {index}-{index + count - 1}: {str(e)}")
+                        if not self.args.skip_errors:
+                            raise
+                        # Keep the output frame count in sync with the input
+                        enhanced = np.stack([
+                            cv2.resize(frame, (width * scale, height * scale),
+                                       interpolation=cv2.INTER_CUBIC)
+                            for frame in host_batch[:count].numpy()
+                        ])
+                        
+                    # The staging buffer is free again once its upload has landed
+                    if uploaded is not None:
+                        uploaded.synchronize()
+                    free_q.put(host_batch)
+                    if not queue_put(write_q, (enhanced, count, done), stop):
+                        break
+                    index += count
+                    
+                queue_put(write_q, None, stop)
+                writer.join()
+                if errors:
+                    raise errors[0]
+            finally:
+                stop.set()
+        return index
+        
+    def finish_process(self, proc, name):
+        if proc.stdin:
+            proc.stdin.close()
+        if proc.wait() != 0:
+            raise RuntimeError(f"{name} exited with code {proc.returncode}")
                 
-    def reconstruct_video(self):
-        fps = self.get_video_fps(self.args.input)
-        logger.info(f"Reconstructing video at {fps} FPS")
+    def check_output(self, path):
+        # ffmpeg can exit 0 after writing an empty or truncated file
+        if not os.path.exists(path):
+            raise RuntimeError(f"{path} was not written")
+        size = os.path.getsize(path)
+        if size < MIN_OUTPUT_BYTES:
+            raise RuntimeError(f"{path} is only {size} bytes")
+            
+    def cleanup(self):
+        if not self.args.keep_temp:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            
+    def upscale(self):
+        decoder = encoder = None
+        try:
+            info = probe(self.input)
+            width, height, fps = info['width'], info['height'], info['fps']
+            logger.info(f"Streaming {self.input} at {fps} FPS, encoding with {self.encoder}")
+            
+            decoder = self.open_decoder()
+            encoder = self.open_encoder(width * self.args.scale, height * self.args.scale,
+                                        info['frame_rate'])
+            frame_count = self.process_frames(decoder, encoder, width, height)
+            
+            self.finish_process(decoder, "Decoder")
+            if frame_count == 0:
+                # A shard that starts past EOF (the frame estimate ran long)
+                # has nothing to encode; the parent leaves it out of the join
+                if self.segment is not None:
+                    return 0
+                raise RuntimeError(f"No frames decoded from {self.input}")
+            self.finish_process(encoder, "Encoder")
+            self.check_output(self.output)
+            return frame_count
+        finally:
+            for proc in (decoder, encoder):
+                if proc is not None and proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+    
+    def upscale_sharded(self):
+        shards = self.args.shards
+        info = probe(self.input)
+        total_frames = info['nb_frames']
+        if not total_frames and info['duration']:
+            total_frames = round(info['duration'] * info['fps'])
+        if not total_frames:
+            # Shard boundaries need a frame count; streams without one
+            # (some MKV/WebM) can still be upscaled in a single pass
+            logger.warning(f"{self.input} reports neither a frame count nor a duration; "
+                           f"ignoring --shards {shards}")
+            return self.upscale()
+        shard_frames = math.ceil(total_frames / shards)
+        os.makedirs(self.temp_dir, exist_ok=True)
+        
+        # Workers share one GPU, so shrink their tiles and batches to match
+        shard_args = argparse.Namespace(**vars(self.args))
+        shard_args.input = self.input
+        shard_args.encoder = self.encoder
+        # Probe here so the workers all find it in the cache
+        if self.encoder == 'x264':
+            nvdec_available()
+        shard_args.keep_temp = True  # the parent owns temp_dir
+        if self.args.tile_size > 0:
+            # Even, because x2 models pixel_unshuffle every tile by 2
+            shard_args.tile_size = max(32, int(self.args.tile_size / math.sqrt(shards)) // 2 * 2)
+        # Build the engine once here; workers racing to build the same file
+        # would clobber each other
+        if shard_args.trt_engine == 'auto':
+            shard_args.trt_engine = cached_trt_engine(shard_args, info['width'], info['height'])
+        
+        jobs = []
+        for k in range(shards):
+            first = k * shard_frames
+            if first >= total_frames:
+                break
+            # The last shard runs to EOF in case the frame estimate is short
+            last_shard = first + shard_frames >= total_frames
+            frame_count = None if last_shard else shard_frames
+            jobs.append((os.path.join(self.temp_dir, f'shard_{k:03d}.mp4'), first, frame_count))
+            
+        logger.info(f"Upscaling {total_frames} frames in {len(jobs)} shards")
+        # CUDA can't survive fork(), so workers must be spawned
+        pool = ProcessPoolExecutor(max_workers=len(jobs),
+                                   mp_context=multiprocessing.get_context('spawn'))
+        try:
+            futures = [
+                pool.submit(upscale_shard, shard_args, path, first, frame_count, 1 / len(jobs))
+                for path, first, frame_count in jobs
+            ]
+            frame_counts = [future.result() for future in futures]
+        except BaseException:
+            # Otherwise the surviving shards finish their whole GPU run
+            # before the error is reported
+            workers = list((pool._processes or {}).values())
+            pool.shutdown(wait=False, cancel_futures=True)
+            for worker in workers:
+                worker.terminate()
+            raise
+        pool.shutdown()
+            
+        empty = [path for (path, _, _), count in zip(jobs, frame_counts) if count == 0]
+        if empty:
+            logger.warning(f"Dropping {len(empty)} empty trailing shards (frame estimate was long)")
+        jobs = [job for job, count in zip(jobs, frame_counts) if count]
+        if not jobs:
+            raise RuntimeError(f"No frames decoded from {self.input}")
         
+        concat_list = os.path.join(self.temp_dir, 'concat.txt')
+        with open(concat_list, 'w') as f:
+            for path, _, _ in jobs:
+                escaped = path.replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+                
+        # Stream-copy join, no re-encode
         subprocess.run([
             'ffmpeg', '-hide_banner', '-loglevel', 'error',
-            '-framerate', str(fps),
-            '-i', f'{self.enhanced_dir}/%06d.jpg',
-            '-i', self.args.input,
+            '-f', 'concat', '-safe', '0',
+            '-i', concat_list,
+            '-i', self.input,
             '-map', '0:v:0',
             '-map', '1:a:0?',  # Optional audio
-            '-c:a', 'copy',
-            '-c:v', 'libx264',
-            '-crf', '18',
-            '-preset', 'slow',
-            '-pix_fmt', 'yuv420p',
-            '-y',  # Overwrite without asking
-            self.args.output
+            '-c', 'copy',
+            *container_args(self.output),
+            '-y',
+            self.output
         ], check=True)
+        self.check_output(self.output)
         
-    def cleanup(self):
-        if not self.args.keep_temp:
-            shutil.rmtree(self.temp_dir, ignore_errors=True)
-            
     def run(self):
         try:
-            self.extract_frames()
-            self.process_frames()
-            self.reconstruct_video()
-            logger.info(f"Successfully created {self.args.output}")
+            if self.args.shards > 1:
+                self.upscale_sharded()
+            else:
+                frame_count = self.upscale()
+                logger.info(f"Upscaled {frame_count} frames")
+            logger.info(f"Successfully created {self.output}")
             return True
         except Exception as e:
             logger.error(f"Processing failed: {str(e)}")
             return False
         finally:
             self.cleanup()
+            
+    def run_batch(self, input_dir, pattern, output_dir):
+        # One process, one resident model and one encoder probe for every clip
+        inputs = sorted(glob.glob(os.path.join(input_dir, pattern)))
+        if not inputs:
+            logger.error(f"No files matching {pattern} in {input_dir}")
+            return False
+        os.makedirs(output_dir, exist_ok=True)
+        
+        failed = []
+        for index, path in enumerate(inputs, 1):
+            output = os.path.join(output_dir, os.path.basename(path))
+            if os.path.abspath(output) == os.path.abspath(path):
+                logger.error(f"Refusing to overwrite input {path}; use a different --output directory")
+                failed.append(path)
+                continue
+            logger.info(f"[{index}/{len(inputs)}] {path} -> {output}")
+            self.input, self.output = path, output
+            if not self.run():
+                failed.append(path)
+                
+        if failed:
+            logger.error(f"{len(failed)} of {len(inputs)} clips failed: {', '.join(failed)}")
+        return not failed
+
+def upscale_shard(args, output, first_frame, frame_count, vram_share):
+    shard_args = argparse.Namespace(**vars(args))
+    shard_args.output = output
+    upscaler = VideoUpscaler(shard_args, segment=(first_frame, frame_count), vram_share=vram_share)
+    return upscaler.upscale()
 
 def parse_args():
     parser = argparse.ArgumentParser(description="AI Video Upscaler")
-    parser.add_argument('--input', required=True, help="Input video file")
-    parser.add_argument('--output', required=True, help="Output video file")
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--input', help="Input video file")
+    inputs.add_argument('--input_dir', help="Upscale every file in this directory matching --glob")
+    parser.add_argument('--glob', default='*.mp4', help="File pattern for --input_dir")
+    parser.add_argument('--output', required=True, help="Output video file (output directory with --input_dir)")
     parser.add_argument('--temp_dir', default='temp', help="Temporary working directory")
     parser.add_argument('--scale', type=int, default=4, choices=[2,4], help="Upscaling factor")
     parser.add_argument('--tile_size', type=int, default=400, help="Tile size for GPU memory management")
+    parser.add_argument('--batch_size', type=int, default=0, help="Frames per inference batch (0 = auto from tile size and free VRAM)")
+    parser.add_argument('--prefetch', type=int, default=PIPELINE_DEPTH, help="Batches buffered between the decode, inference and encode stages")
+    parser.add_argument('--precision', default='fp16', choices=list(PRECISIONS), help="Inference precision on CUDA (CPU always uses fp32)")
+    parser.add_argument('--channels_last', action='store_true', help="Run the model in channels_last (NHWC) memory format on CUDA")
+    parser.add_argument('--compile', action='store_true', help="Wrap the model in torch.compile (slow start, faster steady state)")
+    parser.add_argument('--encoder', default='auto', choices=['auto', *VIDEO_ENCODERS], help="Video encoder (auto picks nvenc when it works, else x264; qsv/vaapi for Intel/AMD)")
+    parser.add_argument('--preset', help="Encoder preset (default: medium for x264, p5 for NVENC, slow for QSV)")
+    parser.add_argument('--crf', type=int, help="Encoder quality: x264 CRF, NVENC CQ, QSV global_quality or VAAPI QP (default 19)")
+    parser.add_argument('--shards', type=int, default=1, help="Split the video into N time ranges upscaled by parallel workers")
     parser.add_argument('--model_path', default='weights/RealESRGAN_x4plus.pth', help="Path to model weights")
+    parser.add_argument('--trt_engine', help="TensorRT engine built by scripts/build_trt.py to run instead of PyTorch, or 'auto' to build and cache one per input shape")
+    parser.add_argument('--warmup_batches', type=int, default=2, help="Dummy batches run on CUDA before timing starts (0 disables)")
     parser.add_argument('--keep_temp', action='store_true', help="Keep temporary files")
     parser.add_argument('--skip_errors', action='store_true', help="Continue on frame processing errors")
     return parser.parse_args()
@@ -138,5 +948,8 @@ def parse_args():
 if __name__ == "__main__":
     args = parse_args()
     upscaler = VideoUpscaler(args)
-    success = upscaler.run()
+    if args.input_dir:
+        success = upscaler.run_batch(args.input_dir, args.glob, args.output)
+    else:
+        success = upscaler.run()
     exit(0 if success else 1)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import subprocess
+import torch
+import logging
+from basicsr.archs.rrdbnet_arch import RRDBNet
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def load_model(model_path, scale):
+    model = RRDBNet(
+        num_in_ch=3, num_out_ch=3,
+        num_feat=64, num_block=23,
+        num_grow_ch=32, scale=scale
+    )
+    # Same key lookup as RealESRGANer
+    loadnet = torch.load(model_path, map_location='cpu')
+    keyname = 'params_ema' if 'params_ema' in loadnet else 'params'
+    model.load_state_dict(loadnet[keyname], strict=True)
+    return model.eval()
+
+def export_onnx(model, onnx_path, size):
+    dummy = torch.randn(1, 3, size, size)
+    logger.info(f"Exporting ONNX graph to {onnx_path}")
+    torch.onnx.export(
+        model, dummy, onnx_path,
+        opset_version=17,
+        input_names=['input'],
+        output_names=['output'],
+        dynamic_axes={
+            'input': {0: 'B', 2: 'H', 3: 'W'},
+            'output': {0: 'B', 2: 'H', 3: 'W'},
+        }
+    )
+
+def build_engine(args, onnx_path, engine_path):
+    # Tiles are padded on both sides; edge tiles can be only a few pixels
+    # wide (W % tile + tile_pad). The x4 RRDBNet takes any size, but x2
+    # pixel_unshuffles its input by 2 and needs even sizes (the upscaler
+    # pads frames to match, the same mod_scale RealESRGANer uses)
+    min_size = 2 if args.scale == 2 else 1
+    if args.tile_size > 0:
+        height = width = args.tile_size + 2 * args.tile_pad
+    else:
+        width, height = args.max_width, args.max_height
+    shapes = {
+        'minShapes': f'input:1x3x{min_size}x{min_size}',
+        'optShapes': f'input:{args.batch_size}x3x{height}x{width}',
+        'maxShapes': f'input:{args.batch_size}x3x{height}x{width}',
+    }
+
+    logger.info(f"Building TensorRT engine {args.engine}")
+    subprocess.run([
+        'trtexec',
+        f'--onnx={onnx_path}',
+        f'--saveEngine={engine_path}',
+        *(['--fp16'] if args.precision == 'fp16' else []),
+        *[f'--{key}={value}' for key, value in shapes.items()],
+    ], check=True)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build a TensorRT engine for the Real-ESRGAN upscaler")
+    parser.add_argument('--model_path', default='weights/RealESRGAN_x4plus.pth', help="Path to model weights")
+    parser.add_argument('--scale', type=int, default=4, choices=[2,4], help="Upscaling factor")
+    parser.add_argument('--engine', default='weights/rrdb_fp16.engine', help="Output engine file")
+    parser.add_argument('--onnx', help="Intermediate ONNX file (default: next to the engine)")
+    parser.add_argument('--precision', default='fp16', choices=['fp16', 'fp32'], help="Engine precision")
+    parser.add_argument('--tile_size', type=int, default=400, help="Tile size the engine will be run with (0 = whole frames)")
+    parser.add_argument('--tile_pad', type=int, default=10, help="Tile padding used by the upscaler")
+    parser.add_argument('--max_width', type=int, default=1920, help="Largest frame width when --tile_size is 0")
+    parser.add_argument('--max_height', type=int, default=1080, help="Largest frame height when --tile_size is 0")
+    parser.add_argument('--batch_size', type=int, default=4, help="Largest batch the engine accepts")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    # Build under per-process names and move the engine into place at the
+    # end, so an interrupted or concurrent build never leaves a partial
+    # engine at the path process_video.py looks for
+    tmp_suffix = f'.{os.getpid()}.tmp'
+    onnx_path = args.onnx or os.path.splitext(args.engine)[0] + tmp_suffix + '.onnx'
+    engine_path = args.engine + tmp_suffix
+    try:
+        model = load_model(args.model_path, args.scale)
+        export_onnx(model, onnx_path, 64)
+        build_engine(args, onnx_path, engine_path)
+        os.replace(engine_path, args.engine)
+    finally:
+        if os.path.exists(engine_path):
+            os.remove(engine_path)
+        if not args.onnx and os.path.exists(onnx_path):
+            os.remove(onnx_path)
+    logger.info(f"Run process_video.py with --trt_engine {args.engine} --tile_size {args.tile_size}")
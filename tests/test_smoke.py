@@ -0,0 +1,58 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('realesrgan')
+from basicsr.archs.rrdbnet_arch import RRDBNet
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import process_video
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="needs ffmpeg")
+
+def test_cpu_upscale(tmp_path, monkeypatch):
+    # Random weights are enough to exercise decode -> batch -> encode end to end
+    model_path = tmp_path / 'random_x2.pth'
+    model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=2)
+    torch.save({'params_ema': model.state_dict()}, model_path)
+    
+    source = tmp_path / 'source.mp4'
+    subprocess.run([
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', 'testsrc=size=64x64:rate=5:duration=1',
+        '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+        str(source)
+    ], check=True)
+    
+    output = tmp_path / 'upscaled.mp4'
+    monkeypatch.setattr(torch.cuda, 'is_available', lambda: False)
+    monkeypatch.setattr(process_video, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(sys, 'argv', [
+        'process_video.py',
+        '--input', str(source),
+        '--output', str(output),
+        '--temp_dir', str(tmp_path / 'temp'),
+        '--model_path', str(model_path),
+        '--scale', '2',
+        '--tile_size', '0',
+        '--encoder', 'x264',
+    ])
+    upscaler = process_video.VideoUpscaler(process_video.parse_args())
+    assert upscaler.run()
+    
+    result = subprocess.run([
+        'ffprobe', '-v', 'error',
+        '-select_streams', 'v:0',
+        '-count_frames',
+        '-show_entries', 'stream=width,height,nb_read_frames',
+        '-of', 'json',
+        str(output)
+    ], stdout=subprocess.PIPE, text=True, check=True)
+    stream = json.loads(result.stdout)['streams'][0]
+    assert (stream['width'], stream['height']) == (128, 128)
+    assert int(stream['nb_read_frames']) == 5